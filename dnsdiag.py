@@ -5,20 +5,38 @@ This script is used to diagnose DNS issues.
 '''
 
 import argparse
+import asyncio
+import functools
+import logging
 import dns.resolver
 import dns.query
+import dns.asyncquery
+import dns.asyncbackend
+import dns.inet
 import dns.zone
 import dns.reversename
 import dns.rdatatype
 import dns.rdataclass
 import dns.exception
+import hashlib
+import itertools
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import time
 import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import os
+import random
+import socket
 import sys
 
-VERBOSE = False
+log = logging.getLogger('dnsdiag')
 
 def get_args():
     parser = argparse.ArgumentParser(description='DNS Diagnostics')
@@ -29,22 +47,37 @@ def get_args():
 
 def load_config(config_file):
     with open(config_file) as f:
-        return yaml.safe_load(f)
+        return yaml.load(f, Loader=SafeLoader)
 
 def store_report(details):
-    fname = 'dnsdiag-report-{}.txt'.format(time.strftime('%Y%m%d-%H%M%S'))
-    # if file exists write -NNN to filename
-    seq = 0
-    while os.path.exists(fname):
-        fname = 'dnsdiag-report-{}-{}.txt'.format(time.strftime('%Y%m%d-%H%M%S'), str(seq).zfill(3))
-        seq += 1
-
     header = f'DNS Diagnostics Report - {time.strftime("%Y-%m-%d %H:%M:%S")}\n'
-    with open(fname, 'w') as f:
+    # sub-second suffix + O_EXCL create, retry only on a real collision
+    while True:
+        fname = 'dnsdiag-report-{}-{:06d}.txt'.format(time.strftime('%Y%m%d-%H%M%S'), time.time_ns() % 1_000_000)
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            break
+        except FileExistsError:
+            continue
+    with os.fdopen(fd, 'w') as f:
         f.write(details)
     print(f'Report saved to {fname}')
     print(details)
 
+def json_canonical(data):
+    '''
+    Compact sorted-keys JSON bytes, orjson when available
+    '''
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(data, sort_keys=True, separators=(',', ':')).encode()
+
+def json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+@functools.lru_cache(maxsize=None)
 def rdtype_to_text(rdtype):
     '''
     Stub function to convert rdtype to text
@@ -56,74 +89,101 @@ def rdtype_to_text(rdtype):
 class DNSDiag:
     def __init__(self, config):
         self.config = config
-        # iterate over dns tests, and if 
+        # name2ip cache: (domain, dnssec) -> (ips, expiry timestamp)
+        self._name_cache = {}
+        # caps sockets in flight across all concurrent tests, set in arun
+        self._query_sem = None
+        # iterate over dns tests, and if
 
-    def test_resolver(self, resolver):
+    async def _atest_resolver(self, resolver):
         '''
         Make dummy . NS query to test resolver
         '''
-        valid_answers = ['a.root-servers.net.', 'b.root-servers.net.', 'c.root-servers.net.', 'd.root-servers.net.', 'e.root-servers.net.', 'f.root-servers.net.', 'g.root-servers.net.', 'h.root-servers.net.', 'i.root-servers.net.', 'j.root-servers.net.', 'k.root-servers.net.', 'l.root-servers.net.', 'm.root-servers.net.']
         try:
             query = dns.message.make_query('.', dns.rdatatype.NS)
             if resolver['type'] == 'tcp':
-                response = dns.query.tcp(query, resolver['ip'], timeout=10)
+                response = await dns.asyncquery.tcp(query, resolver['ip'], timeout=10)
             else:
-                response = dns.query.udp(query, resolver['ip'], timeout=10)
-            for answer in response.answer:
-                for rrset in answer:
-                    if rrset.rdtype == dns.rdatatype.NS and rrset.to_text() in valid_answers:
-                        return True
+                response = await dns.asyncquery.udp(query, resolver['ip'], timeout=10)
+            for rrset in itertools.chain.from_iterable(response.answer):
+                if rrset.rdtype == dns.rdatatype.NS and rrset.to_text().endswith('.root-servers.net.'):
+                    return True
         except dns.exception.DNSException as e:
             print(e)
 
         return False
-    
+
+    async def _race_resolvers(self, resolvers):
+        '''
+        Probe all resolvers at once, first valid responder wins
+        '''
+        tasks = {asyncio.create_task(self._atest_resolver(resolver)): resolver for resolver in resolvers}
+        winner = None
+        pending = set(tasks)
+        while pending and winner is None:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    if task.result():
+                        winner = tasks[task]
+                        break
+                except dns.exception.DNSException as e:
+                    print(e)
+        for task in pending:
+            task.cancel()
+        return winner
+
     def test_all_resolvers(self):
         resolvers = self.config.get('resolvers', [])
         self.config['tested_resolver'] = None
-        # verify resolvers and pick first working resolver
-        for resolver in resolvers:
-            try:
-                if self.test_resolver(resolver):
-                    self.config['tested_resolver'] = resolver
-                    break
-                break
-            except dns.exception.DNSException as e:
-                print(e)
-                continue
-        
-        if VERBOSE:
-            if self.config['tested_resolver']:
-                print('Using resolver: {}'.format(self.config['tested_resolver']))
-            else:
-                print('No working resolver found')
+        # race all resolvers in parallel and pick first working one
+        if resolvers:
+            self.config['tested_resolver'] = asyncio.run(self._race_resolvers(resolvers))
+
+        if self.config['tested_resolver']:
+            log.debug('Using resolver: {}'.format(self.config['tested_resolver']))
+        else:
+            log.debug('No working resolver found')
         
         if not self.config['tested_resolver']:
             raise Exception('No working resolver found')
     
-    def name2ip(self, domain):
+    async def name2ip(self, domain):
+        dnssec_opt = self.config['tested_resolver'].get('dnssec', False)
+        cache_key = (domain, dnssec_opt)
+        cached = self._name_cache.get(cache_key)
+        if cached and cached[1] > time.time():
+            log.debug(f'Using cached IPs for {domain}')
+            return cached[0]
         retanswer = []
         attempts = 10
+        backoff = 0.05
+        ttl = 60
         while True:
             try:
-                dnssec_opt = self.config['tested_resolver'].get('dnssec', False)
-                if VERBOSE:
-                    print(f'Querying {domain} with DNSSEC: {dnssec_opt}')
-                query = dns.message.make_query(domain, dns.rdatatype.A, want_dnssec=dnssec_opt)
+                log.debug(f'Querying {domain} with DNSSEC: {dnssec_opt}')
+                query = dns.message.make_query(domain, dns.rdatatype.A, use_edns=0, payload=4096, want_dnssec=dnssec_opt)
                 if self.config['tested_resolver']['type'] == 'tcp':
-                    response = dns.query.tcp(query, self.config['tested_resolver']['ip'], timeout=10)
+                    response = await dns.asyncquery.tcp(query, self.config['tested_resolver']['ip'], timeout=10)
                 else:
-                    response = dns.query.udp(query, self.config['tested_resolver']['ip'], timeout=10)
-                for answer in response.answer:
-                    for rrset in answer:
-                        if rrset.rdtype == dns.rdatatype.A:
-                            retanswer.append(rrset.to_text())
+                    response = await dns.asyncquery.udp(query, self.config['tested_resolver']['ip'], timeout=10)
+                if response.answer:
+                    ttl = min(rrset.ttl for rrset in response.answer)
+                retanswer.extend(rr.to_text() for rr in itertools.chain.from_iterable(response.answer)
+                                 if rr.rdtype == dns.rdatatype.A)
                 break
             except dns.exception.DNSException as e:
                 print(f"Error: {e}, retrying...")
                 attempts -= 1
                 if attempts == 0:
+                    # serve stale cache entry rather than fail outright
+                    if cached:
+                        print(f'Serving stale cache entry for {domain}')
+                        return cached[0]
                     break
+                # back off with jitter, yields the loop to other resolves
+                await asyncio.sleep(backoff + random.uniform(0, backoff))
+                backoff = min(backoff * 2, 2.0)
             except Exception as e:
                 print(f"Error: {e}")
                 break
@@ -135,7 +195,8 @@ class DNSDiag:
                     print(f'Options: {response.options.to_text()}')
                         
             raise Exception(f'No A record found for {domain} at {self.config["tested_resolver"]["ip"]}')
-        
+
+        self._name_cache[cache_key] = (retanswer, time.time() + ttl)
         return retanswer
     
     '''
@@ -154,7 +215,48 @@ class DNSDiag:
             print(e)
     '''
 
-    def test_dns_query(self, test):
+    async def _query_ns(self, query_name, queries, ns_ip, q_proto, sem):
+        '''
+        Run all query_types against one nameserver over a single socket
+        '''
+        responses = []
+        async with sem:
+            backend = dns.asyncbackend.get_default_backend()
+            af = dns.inet.af_for_address(ns_ip)
+            if q_proto == 'tcp':
+                sock = await backend.make_socket(af, socket.SOCK_STREAM, 0, None, (ns_ip, 53), 10)
+            else:
+                sock = await backend.make_socket(af, socket.SOCK_DGRAM)
+            try:
+                for query_type, query in queries:
+                    log.debug(f'Querying {query_name} {query_type} on {ns_ip}...')
+                    try:
+                        if q_proto == 'tcp':
+                            responses.append(await dns.asyncquery.tcp(query, ns_ip, timeout=10, sock=sock))
+                        else:
+                            responses.append(await dns.asyncquery.udp(query, ns_ip, timeout=10, sock=sock))
+                    except dns.exception.DNSException as e:
+                        responses.append(e)
+            finally:
+                await sock.close()
+        return responses
+
+    async def _run_queries(self, query_name, query_types, nameservers_ips, q_proto):
+        '''
+        Fire all nameservers concurrently, one socket per nameserver
+        '''
+        sem = self._query_sem
+        dnssec_opt = self.config['tested_resolver'].get('dnssec', False)
+        # same wire message for every nameserver, build each once
+        # resolve query_type strings to rdatatype ints up front
+        qt_ints = {query_type: dns.rdatatype.from_text(query_type) for query_type in query_types}
+        queries = [(query_type, dns.message.make_query(query_name, qt_ints[query_type], use_edns=0, payload=4096, want_dnssec=dnssec_opt))
+                   for query_type in query_types]
+        tasks = [self._query_ns(query_name, queries, ns_ip, q_proto, sem)
+                 for ns_ip in nameservers_ips]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def test_dns_query(self, test):
         '''
         We have query_name (str), query_types (list), nameservers (list)
         '''
@@ -164,16 +266,15 @@ class DNSDiag:
         q_proto = test.get('query_protocol', 'udp')
         nameservers_ips = []
         # convert nameservers to nameservers_ips
-        if VERBOSE:
-            print('Converting nameservers to IPs...')
+        log.debug('Converting nameservers to IPs...')
         for ns in nameservers:
-            if VERBOSE:
-                print(f'Converting {ns} to IP...')
-            ip = self.name2ip(ns)
+            log.debug(f'Converting {ns} to IP...')
+            ip = await self.name2ip(ns)
             nameservers_ips.extend(ip)
-        
-        if VERBOSE:
-            print('Nameservers IPs: {}'.format(nameservers_ips))
+        # dedupe and sort once, every loop below iterates this same list
+        nameservers_ips = sorted(set(nameservers_ips))
+
+        log.debug('Nameservers IPs: {}'.format(nameservers_ips))
 
         answers = {}
         # store nameserver names and ips in answers and sort
@@ -182,34 +283,24 @@ class DNSDiag:
         answers['nameservers']['names'] = nameservers
         answers['nameservers_ips']['ips'] = nameservers_ips
         answers['nameservers']['names'].sort()
-        answers['nameservers_ips']['ips'].sort()
 
-        # for query_types on each of nameservers_ips and save in array of answers
-        for query_type in query_types:
+        # fire all nameservers concurrently and save in array of answers
+        results = await self._run_queries(query_name, query_types, nameservers_ips, q_proto)
+        for qt_idx, query_type in enumerate(query_types):
             answers[query_type] = {}
-            for ns_ip in nameservers_ips:
-                try:
-                    answers[query_type][ns_ip] = []
-                    dnssec_opt = self.config['tested_resolver'].get('dnssec', False)
-                    query = dns.message.make_query(query_name, query_type, want_dnssec=dnssec_opt)
-                    if VERBOSE:
-                        print(f'Querying {query_name} {query_type} on {ns_ip}...')
-                    
-                    if q_proto == 'tcp':
-                        response = dns.query.tcp(query, ns_ip, timeout=10)
-                    else:
-                        response = dns.query.udp(query, ns_ip, timeout=10)
-                    for answer in response.answer:
-                        for rrset in answer:
-                            rrinfo = rdtype_to_text(rrset.rdtype)
-                            rrinfo += ' ' + rrset.to_text()
-                            print(f'Adding {rrinfo} to answers')
-                            answers[query_type][ns_ip].append(rrinfo)
-                except dns.exception.DNSException as e:
-                    print(e)
+            for ns_idx, ns_ip in enumerate(nameservers_ips):
+                answers[query_type][ns_ip] = []
+                per_ns = results[ns_idx]
+                response = per_ns if isinstance(per_ns, Exception) else per_ns[qt_idx]
+                if isinstance(response, Exception):
+                    print(response)
+                    continue
+                rrinfos = [rdtype_to_text(rr.rdtype) + ' ' + rr.to_text()
+                           for rr in itertools.chain.from_iterable(response.answer)]
+                log.debug(f'Adding {rrinfos} to answers')
+                answers[query_type][ns_ip] = rrinfos
         
-        if VERBOSE:
-            print(answers)
+        log.debug(answers)
         
         # now verify if all answers for each query same across all nameservers
         for query_type in query_types:
@@ -218,13 +309,15 @@ class DNSDiag:
             if not answers[query_type]:
                 print(f'No answers found for {query_name} {query_type}')
                 continue
-            elif VERBOSE:
-                print(f'Answers found for {query_name} {query_type}: {len(answers[query_type])}')
-            answers[query_type][nameservers_ips[0]].sort()
+            log.debug(f'Answers found for {query_name} {query_type}: {len(answers[query_type])}')
+            # canonicalize each nameserver's answers once: dedupe, sort, fingerprint
+            fingerprints = {}
+            for ns_ip in nameservers_ips:
+                answers[query_type][ns_ip] = sorted(set(answers[query_type][ns_ip]))
+                fingerprints[ns_ip] = hashlib.blake2b('\n'.join(answers[query_type][ns_ip]).encode(), digest_size=16).digest()
+            ref_fingerprint = fingerprints[nameservers_ips[0]]
             for ns_ip in nameservers_ips:
-                # sort arrays
-                answers[query_type][ns_ip].sort()
-                if answers[query_type][ns_ip] != answers[query_type][nameservers_ips[0]]:
+                if fingerprints[ns_ip] != ref_fingerprint:
                     report = f'Inconsistent nameservers results for {query_name} {query_type} on {ns_ip}\n'
                     report += f'Reference nameserver: {nameservers_ips[0]}\nExpected:\n'
                     for entry in answers[query_type][nameservers_ips[0]]:
@@ -236,51 +329,73 @@ class DNSDiag:
                         report += f'{entry}\n'
                     store_report(report)
 
-            if VERBOSE:
-                print(f'All nameservers returned same results for {query_name} {query_type}')
+            log.debug(f'All nameservers returned same results for {query_name} {query_type}')
             # make sure answers always sorted and consistent for comparison
 
         # sort answers
         answers = dict(sorted(answers.items()))
 
         stored_fname = f'dnsdiag-report-{test["name"]}.json'
-        # if file doesn't exist, create it, and store results
+        hash_fname = f'dnsdiag-report-{test["name"]}.sha256'
+        canonical = json_canonical(answers)
+        digest = hashlib.sha256(canonical).hexdigest()
+
+        # if file doesn't exist, create it, and store results + hash
         if not os.path.exists(stored_fname):
-            with open(stored_fname, 'w') as f:
-                json.dump(answers, f)
+            with open(stored_fname, 'wb') as f:
+                f.write(canonical)
+            with open(hash_fname, 'w') as f:
+                f.write(digest)
+            return
 
-        # compare stored previous results (json) with current results
+        # compare stored hash with current results hash
         # if not same, report, and store new data
-        with open(stored_fname) as f:
-            prev_results = json.load(f)
-            if prev_results != answers:
-                report = f'Mismatch for {query_name} with previous results\n'
-                report += f'Expected:\n{prev_results}\n'
-                report += f'Got:\n{answers}\n'
-                store_report(report)
-                # rename old results with timestamp
-                new_fname = f'dnsdiag-report-{test["name"]}-{time.strftime("%Y%m%d-%H%M%S")}.json'
-                os.rename(stored_fname, new_fname)
-                # store new results
-                with open(stored_fname, 'w') as f:
-                    json.dump(answers, f)
-            else:
-                if VERBOSE:
-                    print(f'Previous results match for {query_name}')
+        if os.path.exists(hash_fname):
+            with open(hash_fname) as f:
+                stored_digest = f.read().strip()
+        else:
+            # older report without sidecar hash, recompute from its contents
+            with open(stored_fname, 'rb') as f:
+                stored_digest = hashlib.sha256(json_canonical(json_loads(f.read()))).hexdigest()
 
-    def run(self):
+        if stored_digest != digest:
+            # only parse the previous report when we actually need the diff
+            with open(stored_fname, 'rb') as f:
+                prev_results = json_loads(f.read())
+            report = f'Mismatch for {query_name} with previous results\n'
+            report += f'Expected:\n{prev_results}\n'
+            report += f'Got:\n{answers}\n'
+            store_report(report)
+            # archive old results with timestamp, then swap in new results atomically
+            archive_fname = f'dnsdiag-report-{test["name"]}-{time.strftime("%Y%m%d-%H%M%S")}.json'
+            tmp_fname = stored_fname + '.tmp'
+            with open(tmp_fname, 'wb') as f:
+                f.write(canonical)
+            os.link(stored_fname, archive_fname)
+            os.replace(tmp_fname, stored_fname)
+            with open(hash_fname, 'w') as f:
+                f.write(digest)
+        else:
+            log.debug(f'Previous results match for {query_name}')
+
+    async def arun(self):
+        # one event loop for the whole run, tests overlap on the network
+        self._query_sem = asyncio.Semaphore(128)
+        tasks = []
         tests = self.config.get('dns', [])
         for test in tests:
             if test['type'] == 'query':
-                if VERBOSE:
-                    print('Testing query: {}'.format(test['query_name']))
-                self.test_dns_query(test)
+                log.debug('Testing query: {}'.format(test['query_name']))
+                tasks.append(self.test_dns_query(test))
+        await asyncio.gather(*tasks)
+
+    def run(self):
+        asyncio.run(self.arun())
 
 def main():
-    global VERBOSE
     args = get_args()
-    if args.verbose:
-        VERBOSE = True
+    logging.basicConfig(format='%(message)s')
+    log.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
 
     config = load_config(args.config)
     dnsdiag = DNSDiag(config)